@@ -1,11 +1,21 @@
-import json
-import requests
+import orjson
+import functools
+import copy
+import httpx
+import importlib.util
 import gradio as gr
-from typing import Iterator
+from typing import AsyncIterator
 from datetime import datetime
 import os
+import asyncio
+import getpass
+import time
 import tiktoken
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import accumulate, islice
+from bisect import bisect_left
 
 # 初始化tokenizer
 encoding = tiktoken.get_encoding("cl100k_base")
@@ -13,19 +23,66 @@ encoding = tiktoken.get_encoding("cl100k_base")
 # 配置常量
 MAX_TOKENS = 4000
 MAX_HISTORY_ITEMS = 20
-MAX_CONVERSATION_LENGTH = 10000
+MAX_MESSAGE_LENGTH = 200_000  # 单条输入最大字符数，超出直接拒绝，避免分词耗时失控
+MIN_REPLY_TOKENS = 256  # 为回复保留的最少token数
+STREAM_FLUSH_CHUNKS = 16  # 累计多少个流式片段刷新一次界面
+STREAM_FLUSH_INTERVAL = 0.05  # 界面刷新最大间隔（秒）
 
-# 确保数据目录存在
-os.makedirs("data/conversations", exist_ok=True)
-os.makedirs("data/training_data", exist_ok=True)
+# API配置
+API_URL = "https://api.deepseek.com/v1/chat/completions"
+API_KEY = "sk-********************************"  # 请替换为您的API密钥
+
+# 异步客户端：复用HTTPS连接，多个用户的流式请求共享一个事件循环
+# HTTP/2 需要安装 httpx[http2]（h2 包），未安装时退回 HTTP/1.1
+_client = httpx.AsyncClient(
+    http2=importlib.util.find_spec("h2") is not None,
+    timeout=httpx.Timeout(None, connect=10),
+    headers={
+        "Authorization": f"Bearer {API_KEY}",
+        "Content-Type": "application/json"
+    },
+    limits=httpx.Limits(max_connections=None, max_keepalive_connections=8)
+)
+
+def ensure_dir(path):
+    """确保目录存在且有写入权限"""
+    try:
+        Path(path).mkdir(parents=True, exist_ok=True)
+        os.chmod(path, 0o755)
+    except Exception as e:
+        print(f"无法创建目录 {path}: {str(e)}")
+        # 备用目录（如/tmp）；容器中UID可能不在/etc/passwd里，getuser() 会抛异常
+        try:
+            user = getpass.getuser()
+        except (KeyError, OSError):
+            user = "anon"
+        temp_path = f"/tmp/ai_conversations/{user}"
+        Path(temp_path).mkdir(parents=True, exist_ok=True)
+        return temp_path
+    return path
+
+# 确保数据目录存在，启动时解析一次
+_CONV_DIR = ensure_dir("data/conversations")
+_TRAIN_DIR = ensure_dir("data/training_data")
+
+# 文件名日期前缀只在启动时格式化一次，配合纳秒时间戳保证文件名唯一
+_DATE = datetime.now().strftime("%Y%m%d")
+
+# 后台写盘线程池，避免文件I/O阻塞流式回复
+_io_pool = ThreadPoolExecutor(max_workers=2)
 
 # --- 新增的缺失函数 ---
+@functools.lru_cache(maxsize=1)
+def _read_profile(path: str, mtime: float) -> dict:
+    """读取并解析配置文件；以修改时间作为缓存键，文件变更后自动失效"""
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())['my_profile']
+
 def load_profile():
     """加载用户配置文件"""
     try:
-        with open('profile.json', 'r', encoding='utf-8') as f:
-            profile = json.load(f)
-            return profile['my_profile']
+        # 返回副本，调用方修改资料不会污染缓存
+        return copy.deepcopy(_read_profile('profile.json', os.path.getmtime('profile.json')))
     except FileNotFoundError:
         print("错误: profile.json 文件未找到")
         # 创建默认配置文件
@@ -38,8 +95,8 @@ def load_profile():
                 "memory": []
             }
         }
-        with open('profile.json', 'w', encoding='utf-8') as f:
-            json.dump(default_profile, f, ensure_ascii=False, indent=2)
+        with open('profile.json', 'wb') as f:
+            f.write(orjson.dumps(default_profile, option=orjson.OPT_INDENT_2))
         return default_profile['my_profile']
     except Exception as e:
         print(f"加载配置文件错误: {str(e)}")
@@ -48,143 +105,184 @@ def load_profile():
 def save_training_data(message: str, profile: dict):
     """保存训练数据"""
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         data = {
-            "timestamp": timestamp,
+            "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S"),
             "message": message,
             "profile": profile
         }
-        filename = f"data/training_data/training_{timestamp}.json"
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        filename = f"{_TRAIN_DIR}/training_{_DATE}_{time.time_ns()}.json"
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
     except Exception as e:
         print(f"保存训练数据失败: {str(e)}")
 # --------------------
 
+# token计数缓存（按文本内容），历史消息只编码一次
+TOKEN_CACHE_SIZE = 8192
+_token_cache = {}
+
+def count_tokens_many(texts: list) -> list:
+    """批量计算token数，未缓存的文本一次性交给tiktoken多线程编码"""
+    counts = {text: _token_cache.get(text) for text in texts}
+    missing = [text for text, count in counts.items() if count is None]
+    if missing:
+        encoded = encoding.encode_ordinary_batch(missing, num_threads=4)
+        for text, tokens in zip(missing, encoded):
+            counts[text] = len(tokens)
+        # 结果已在本地，再淘汰缓存也不会影响本次返回
+        if len(_token_cache) + len(missing) > TOKEN_CACHE_SIZE:
+            _token_cache.clear()
+        _token_cache.update((text, counts[text]) for text in missing)
+    return [counts[text] for text in texts]
+
 def count_tokens(text: str) -> int:
-    return len(encoding.encode(text))
+    return count_tokens_many([text])[0]
 
-def trim_conversation(conversation: list, max_tokens: int) -> list:
+def count_tokens_fast(text: str) -> int:
+    """快速估算token数，不调用tiktoken；非ASCII字符按UTF-8字节数计（字节级BPE的上界），ASCII约4字符1token"""
+    utf8_len = len(text.encode('utf-8'))
+    ascii_len = len(text.encode('ascii', 'ignore'))
+    return (ascii_len + 3) // 4 + (utf8_len - ascii_len)
+
+def estimate_tokens_many(texts: list) -> list:
+    """用于预算裁剪：已精确计数过的文本直接用缓存，其余用快速估算"""
+    return [_token_cache.get(text) or count_tokens_fast(text) for text in texts]
+
+def trim_conversation(conversation: deque, max_tokens: int) -> deque:
     total_tokens = 0
-    trimmed = []
+    trimmed = deque()
+    
+    tokens = estimate_tokens_many([msg for item in reversed(conversation) for msg in item])
     
-    for item in reversed(conversation):
-        user_msg, bot_msg = item
-        item_tokens = count_tokens(user_msg) + count_tokens(bot_msg)
+    for i, item in enumerate(reversed(conversation)):
+        item_tokens = tokens[2 * i] + tokens[2 * i + 1]
         
         if total_tokens + item_tokens > max_tokens:
             break
             
-        trimmed.insert(0, item)
+        trimmed.appendleft(item)
         total_tokens += item_tokens
     
     return trimmed
 
 def save_conversation(conversation: list):
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    base_filename = f"data/conversations/conversation_{timestamp}"
-    
-    conversation_str = json.dumps(conversation, ensure_ascii=False)
-    if len(conversation_str) > MAX_CONVERSATION_LENGTH:
-        parts = len(conversation_str) // MAX_CONVERSATION_LENGTH + 1
-        for i in range(parts):
-            part = conversation_str[i*MAX_CONVERSATION_LENGTH : (i+1)*MAX_CONVERSATION_LENGTH]
-            filename = f"{base_filename}_part{i+1}.json"
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(part)
-    else:
-        filename = f"{base_filename}.json"
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(conversation_str)
+    try:
+        timestamp = f"{_DATE}_{time.time_ns()}"
+        filename = f"{_CONV_DIR}/conversation_{timestamp}.json"
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(conversation))
+    except Exception as e:
+        print(f"保存对话失败: {str(e)}")
 
-def prepare_api_messages(conversation: list, profile: dict, new_message: str) -> list:
-    system_prompt = {
-        "role": "system",
-        "content": f"""你正在与{profile['name']}对话:
-        年龄: {profile['age']}
-        职业: {profile['profession']}
-        兴趣: {', '.join(profile['interests'])}"""
-    }
+@functools.lru_cache(maxsize=4)
+def build_system_prompt(name: str, age, profession: str, interests: tuple) -> tuple:
+    """构建系统提示词，返回 (内容, token数)；同一用户资料只构建一次"""
+    content = f"""你正在与{name}对话:
+        年龄: {age}
+        职业: {profession}
+        兴趣: {', '.join(interests)}"""
+    return content, count_tokens(content)
+
+def prepare_api_messages(conversation: deque, profile: dict, new_message: str) -> list:
+    system_content, system_tokens = build_system_prompt(
+        profile['name'], profile['age'], profile['profession'], tuple(profile['interests'])
+    )
     
-    messages = [system_prompt]
-    tokens_used = count_tokens(system_prompt["content"])
+    # conversation 已在 respond 中限制为最近 MAX_HISTORY_ITEMS 轮
+    tokens = estimate_tokens_many([new_message] + [msg for item in conversation for msg in item])
+    pair_tokens = [u + b for u, b in zip(tokens[1::2], tokens[2::2])]
     
-    for user_msg, bot_msg in conversation[-MAX_HISTORY_ITEMS:]:
-        user_content = {"role": "user", "content": user_msg}
-        bot_content = {"role": "assistant", "content": bot_msg}
-        
-        new_tokens = count_tokens(user_msg) + count_tokens(bot_msg)
-        if tokens_used + new_tokens > MAX_TOKENS:
-            break
-            
-        messages.extend([user_content, bot_content])
-        tokens_used += new_tokens
+    # 为新消息预留空间，从最近一轮往前累加，二分查找预算内可保留的轮数
+    budget = MAX_TOKENS - system_tokens - tokens[0]
+    keep = bisect_left(list(accumulate(reversed(pair_tokens))), budget)
     
-    if count_tokens(new_message) + tokens_used < MAX_TOKENS:
+    messages = [{"role": "system", "content": system_content}] + [
+        {"role": role, "content": content}
+        for user_msg, bot_msg in islice(conversation, len(conversation) - keep, None)
+        for role, content in (("user", user_msg), ("assistant", bot_msg))
+    ]
+    
+    if budget > 0:
         messages.append({"role": "user", "content": new_message})
     
     return messages
 
-def call_deepseek_api_stream(prompt: str, conversation: list, profile: dict) -> Iterator[str]:
-    api_url = "https://api.deepseek.com/v1/chat/completions"
-    api_key = "sk-********************************"  # 请替换为您的API密钥
-    
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
+async def call_deepseek_api_stream(prompt: str, conversation: deque, profile: dict) -> AsyncIterator[str]:
+    # 分词计算放到线程中执行，避免阻塞事件循环上其他用户的流式回复
+    messages = await asyncio.to_thread(prepare_api_messages, conversation, profile, prompt)
+    # 仅在此处精确计数，结果写入缓存，后续轮次的预算估算可直接复用
+    token_counts = await asyncio.to_thread(count_tokens_many, [m["content"] for m in messages])
+    tokens_used = sum(token_counts)
     
-    messages = prepare_api_messages(conversation, profile, prompt)
+    # ASCII部分仍是近似估算，精确计数超出预算时从最早的一轮历史开始丢弃
+    while (MAX_TOKENS - tokens_used < MIN_REPLY_TOKENS
+           and len(messages) > 2 and messages[2]["role"] == "assistant"):
+        tokens_used -= token_counts[1] + token_counts[2]
+        del messages[1:3], token_counts[1:3]
     
     data = {
         "model": "deepseek-chat",
         "messages": messages,
         "stream": True,
-        "max_tokens": min(2000, MAX_TOKENS - count_tokens(str(messages)))
+        "max_tokens": min(2000, MAX_TOKENS - tokens_used)
     }
     
     try:
-        with requests.post(api_url, headers=headers, json=data, stream=True) as response:
+        async with _client.stream("POST", API_URL, json=data) as response:
             if response.status_code == 200:
-                for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith("data:"):
-                            json_data = decoded_line[5:].strip()
-                            if json_data != "[DONE]":
-                                try:
-                                    chunk = json.loads(json_data)
-                                    if "choices" in chunk and chunk["choices"]:
-                                        content = chunk["choices"][0].get("delta", {}).get("content", "")
-                                        if content:
-                                            yield content
-                                except json.JSONDecodeError:
-                                    pass
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    json_data = line[5:].strip()
+                    if json_data == "[DONE]":
+                        break
+                    try:
+                        chunk = orjson.loads(json_data)
+                        if "choices" in chunk and chunk["choices"]:
+                            content = chunk["choices"][0].get("delta", {}).get("content", "")
+                            if content:
+                                yield content
+                    except orjson.JSONDecodeError:
+                        pass
             else:
                 yield f"[API 错误] 状态码: {response.status_code}"
     except Exception as e:
         yield f"[连接错误] {str(e)}"
 
-def respond(message: str, chat_history: list, profile: dict):
+async def respond(message: str, chat_history: list, profile: dict):
     if not message.strip():
         yield chat_history
         return
     
+    if len(message) > MAX_MESSAGE_LENGTH:
+        yield (chat_history or []) + [(message[:200], "[输入过长，已截断]")]
+        return
+    
     try:
-        save_training_data(message, profile)
-        trimmed_history = trim_conversation(chat_history, MAX_TOKENS // 2)
+        _io_pool.submit(save_training_data, message, profile)
+        history = deque(chat_history or [], maxlen=MAX_HISTORY_ITEMS)
+        trimmed_history = trim_conversation(history, MAX_TOKENS // 2)
+        history_list = list(trimmed_history)
         
         bot_message = ""
-        for chunk in call_deepseek_api_stream(message, trimmed_history, profile):
-            bot_message += chunk
-            yield trimmed_history + [(message, bot_message)]
+        pending = []
+        last_flush = time.monotonic()
+        async for chunk in call_deepseek_api_stream(message, trimmed_history, profile):
+            pending.append(chunk)
+            now = time.monotonic()
+            if len(pending) >= STREAM_FLUSH_CHUNKS or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                bot_message += "".join(pending)
+                pending.clear()
+                last_flush = now
+                yield history_list + [(message, bot_message)]
         
-        full_conversation = trimmed_history + [(message, bot_message)]
-        save_conversation(full_conversation)
+        bot_message += "".join(pending)
+        full_conversation = history_list + [(message, bot_message)]
+        _io_pool.submit(save_conversation, full_conversation)
         yield full_conversation
     except Exception as e:
         print(f"对话出错: {str(e)}")
-        yield chat_history + [(message, f"发生错误: {str(e)}")]
+        yield (chat_history or []) + [(message, f"发生错误: {str(e)}")]
 
 def create_interface(profile: dict):
     with gr.Blocks(title="DeepSeek 聊天助手", theme=gr.themes.Soft()) as demo:
@@ -243,22 +341,6 @@ def create_interface(profile: dict):
     
     return demo
 
-def ensure_dir(path):
-    """确保目录存在且有写入权限"""
-    try:
-        Path(path).mkdir(parents=True, exist_ok=True)
-        os.chmod(path, 0o755)
-    except Exception as e:
-        print(f"无法创建目录 {path}: {str(e)}")
-        # 备用目录（如/tmp）
-        temp_path = f"/tmp/ai_conversations/{os.getlogin()}"
-        Path(temp_path).mkdir(parents=True, exist_ok=True)
-        return temp_path
-    return path
-
-# 在保存文件前调用
-conversation_dir = ensure_dir("data/conversations")
-
 if __name__ == "__main__":
     profile = load_profile()
     if profile: